@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+""" Time the effective sample size and posterior variance computations over a grid of chain counts
+and lengths, writing the results as JSON. """
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+from functools import partial
+
+import numpy as np
+import scipy
+
+from rwmh import (ESS, batch_means_ESS, gelman_rubin, my_ESS, my_gelman_rubin, numba,
+                  rank_diagnostics)
+
+# Diagnostics to time, each called with draws shaped (chains, iters)
+BENCHMARKS = {
+    'ESS': ESS,
+    'gelman_rubin': gelman_rubin,
+    'my_ESS': my_ESS,
+    'my_ESS_lag': partial(my_ESS, method='lag'),
+    'my_ESS_numba': partial(my_ESS, method='numba'),
+    'my_gelman_rubin': my_gelman_rubin,
+    'batch_means_ESS': batch_means_ESS,
+    'rank_diagnostics': rank_diagnostics,
+}
+
+# PyMC's ESS is O(m n^2) pure Python, so is only timed on short chains
+SLOW = {'ESS'}
+
+def ar1_chains(m_chains, n_iters, phi=0.9, seed=0):
+    """ Draws from m_chains AR(1) processes of length n_iters, standing in for MCMC output. """
+    rng = np.random.default_rng(seed)
+    innovations = rng.standard_normal((m_chains, n_iters))
+
+    x = np.empty((m_chains, n_iters))
+    x[:, 0] = innovations[:, 0] / np.sqrt(1 - phi**2)
+    for i in range(1, n_iters):
+        x[:, i] = phi * x[:, i-1] + innovations[:, i]
+
+    return x
+
+def time_function(func, x, warmup, repeat):
+    """ Seconds per call of func(x), for each of repeat timings after warmup untimed calls. """
+    for _ in range(warmup):
+        func(x)
+
+    timer = timeit.Timer(lambda: func(x))
+    n_loops, _ = timer.autorange()
+
+    return n_loops, [total / n_loops for total in timer.repeat(repeat, n_loops)]
+
+def run(names, chains, iters, warmup=1, repeat=5, slow_max_iters=1000):
+    """ Time each named diagnostic over the grid of chain counts and lengths. """
+    results = []
+
+    for m_chains in chains:
+        for n_iters in iters:
+            x = ar1_chains(m_chains, n_iters)
+
+            for name in names:
+                if name in SLOW and n_iters > slow_max_iters:
+                    continue
+
+                n_loops, times = time_function(BENCHMARKS[name], x, warmup, repeat)
+                results.append({'function': name, 'chains': m_chains, 'iters': n_iters,
+                                'loops': n_loops, 'times': times, 'best': min(times),
+                                'median': float(np.median(times))})
+                print("{:>18} chains={:<5} iters={:<9} best={:.3g} s".format(
+                    name, m_chains, n_iters, min(times)), file=sys.stderr)
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--functions', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help="diagnostics to time")
+    parser.add_argument('--chains', nargs='+', type=int, default=[4, 16], help="numbers of chains")
+    parser.add_argument('--iters', nargs='+', type=int, default=[1000, 10000, 100000],
+                        help="chain lengths")
+    parser.add_argument('--warmup', type=int, default=1, help="untimed calls before timing")
+    parser.add_argument('--repeat', type=int, default=5, help="number of timings of each call")
+    parser.add_argument('--slow-max-iters', type=int, default=1000,
+                        help="longest chains to time PyMC's ESS on")
+    parser.add_argument('--output', help="file to write JSON results to, instead of stdout")
+    args = parser.parse_args()
+
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'numba': numba.__version__ if numba is not None else None,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'results': run(args.functions, args.chains, args.iters, args.warmup, args.repeat,
+                       args.slow_max_iters),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
@@ -1,52 +1,520 @@
 #! /usr/bin/env python3
 """ Compare the speed of mine and PyMC's computation of Gelman et. al's effective sample size. """
 
-import matplotlib.pyplot as plt
-plt.style.use('seaborn')
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+from math import lgamma
+
 import numpy as np
-from scipy.stats import norm
+from scipy.fft import irfft, next_fast_len, rfft
+from scipy.stats import beta, norm, rankdata
 
-from IPython import get_ipython
-ipython = get_ipython()
+try:
+    import numba
+except ImportError:
+    numba = None
 
-def my_ESS(x):
-    """ Compute the effective sample size of estimand of interest. Vectorised implementation. """
-    m_chains, n_iters = x.shape
+def my_ESS(x, method='fft', post_var=None, chunk_size=None, monotone=False, return_mcse=False,
+           quantiles=(), dtype=None):
+    """ Compute the effective sample size of estimand of interest. Vectorised implementation.
 
-    variogram = lambda t: ((x[:, t:] - x[:, :(n_iters - t)])**2).sum() / (m_chains * (n_iters - t))
+    x has shape (chains, iters), or (chains, params, iters) to compute the ESS of every parameter
+    at once. With method='fft' the variogram at every lag is found in a single O(m n log n) pass,
+    with method='lag' it is recomputed directly at each lag until the autocorrelations of every
+    parameter are truncated. A precomputed my_gelman_rubin(x) may be passed as post_var, and
+    monotone selects Geyer's initial monotone sequence estimator (see autocorr_sum).
 
-    post_var = my_gelman_rubin(x)
+    With return_mcse=True the Monte Carlo standard errors of the posterior mean and of each of the
+    given quantiles are also returned, as a dict (see mcse).
 
-    t = 1
-    rho = np.ones(n_iters)
-    negative_autocorr = False
+    For draws too large to hold in memory (e.g. an np.memmap), pass chunk_size to read x in pieces:
+    chunk_size iterations at a time with method='lag' or 'numba', bounding memory by chunk_size.
+    The FFT needs a whole chain at once, so method='fft' reads one chain of one parameter at a time
+    whatever chunk_size is, and keeps the autocorrelations of every parameter at every lag, needing
+    memory of a few times the length of one chain per parameter. Quantile standard errors need
+    every draw at once, so are not available with chunk_size.
 
-    # Iterate until the sum of consecutive estimates of autocorrelation is negative
-    while not negative_autocorr and (t < n_iters):
-        rho[t] = 1 - variogram(t) / (2 * post_var)
+    method='numba' computes each lag with a compiled loop which makes no temporary arrays, and
+    falls back to method='lag' if Numba is not installed.
 
-        if not t % 2:
-            negative_autocorr = sum(rho[t-1:t+1]) < 0
+    Temporary arrays keep the floating point type of x (e.g. float32 draws give float32 lagged
+    differences), or use dtype if given, while sums are always accumulated in float64. The FFT
+    is always computed in float64, as its cross products must cancel precisely.
+    """
+    m_chains, n_iters = x.shape[0], x.shape[-1]
 
-        t += 1
+    if method in ('lag', 'numba'):
+        compiled = method == 'numba' and numba is not None
+        variogram = lambda t: (chunked_sq_diffs(x, t, chunk_size or n_iters, dtype, compiled) /
+                               (m_chains * (n_iters - t)))
+    elif method != 'fft':
+        raise ValueError("Unknown method '{}', expected 'fft', 'lag' or 'numba'".format(method))
 
-    return int(m_chains*n_iters / (1 + 2*rho[1:t].sum()))
+    if return_mcse and len(quantiles) and chunk_size:
+        raise ValueError("Quantile standard errors need all of x in memory, so can't use chunk_size")
 
-def my_gelman_rubin(x):
-    """ Estimate the marginal posterior variance. Vectorised implementation. """
-    m_chains, n_iters = x.shape
+    if post_var is None:
+        post_var = my_gelman_rubin(x, chunk_size, dtype)
+
+    if method == 'fft':
+        rho = 1 - fft_variogram(x, chunk_size) / (2 * np.asarray(post_var)[..., np.newaxis])
+    else:
+        t = 1
+        rho = [np.ones(np.shape(post_var))]
+        negative_autocorr = np.zeros(np.shape(post_var), dtype=bool)
+
+        # Iterate until the sum of consecutive estimates of autocorrelation is negative for every
+        # parameter, pairing lags from 0 for monotone=True and from 1 otherwise (see autocorr_sum)
+        while not negative_autocorr.all() and (t < n_iters):
+            rho.append(1 - variogram(t) / (2 * post_var))
+
+            if t % 2 == monotone and t > 1:
+                negative_autocorr |= rho[t-1] + rho[t] < 0
+
+            t += 1
+
+        rho = np.stack(rho, axis=-1)
+
+    ess = m_chains*n_iters / (1 + 2*autocorr_sum(rho, monotone))
+    int_ess = int(ess) if ess.ndim == 0 else ess.astype(int)
+
+    if return_mcse:
+        return int_ess, mcse(x, ess, post_var, quantiles)
+
+    return int_ess
+
+def mcse(x, ess, post_var, quantiles=()):
+    """ Monte Carlo standard errors of the posterior mean and quantiles of x, shaped
+    (chains, iters) or (chains, params, iters), reusing its ESS and posterior variance.
+
+    Returns a dict with the standard error of the mean under 'mean' and of each quantile under its
+    probability. Quantile errors follow Vehtari et al. (2021), using the ESS of the indicators of
+    draws at or below each quantile, found for every quantile in a single FFT pass.
+    """
+    standard_errors = {'mean': np.sqrt(post_var / ess)}
+    if not len(quantiles):
+        return standard_errors
+
+    # Sort the pooled draws of each parameter once, for every quantile
+    x = np.asarray(x)
+    pooled = np.moveaxis(x, 0, -2)
+    pooled = np.sort(pooled.reshape(pooled.shape[:-2] + (-1,)), axis=-1)
+    n_draws = pooled.shape[-1]
+
+    # Indicators of draws at or below each quantile, shaped (chains, quantiles, ..., iters)
+    values = np.quantile(pooled, quantiles, axis=-1)
+    indicators = x[:, np.newaxis] <= values[np.newaxis, ..., np.newaxis]
+    indicator_ess = my_ESS(indicators.astype(float))
+
+    for prob, q_ess in zip(quantiles, indicator_ess):
+        # One standard deviation interval of the draws' CDF at the quantile, mapped to draws
+        lower = beta.ppf(norm.cdf(-1), q_ess*prob + 1, q_ess*(1 - prob) + 1)
+        upper = beta.ppf(norm.cdf(1), q_ess*prob + 1, q_ess*(1 - prob) + 1)
+        i_lower = np.maximum(np.floor(lower * n_draws).astype(int), 0)
+        i_upper = np.minimum(np.ceil(upper * n_draws).astype(int), n_draws - 1)
+
+        standard_errors[prob] = (np.take_along_axis(pooled, i_upper[..., np.newaxis], -1) -
+                                 np.take_along_axis(pooled, i_lower[..., np.newaxis], -1))[..., 0] / 2
+
+    return standard_errors
+
+def fft_variogram(x, chunk_size=None):
+    """ Compute the variogram of x, shaped (chains, ..., iters), at every lag t = 0, ..., n-1 using
+    the FFT. If chunk_size is given, each chain of each parameter is read and transformed on its
+    own, so memory grows with the length of one chain per parameter rather than the size of x. """
+    m_chains, n_iters = x.shape[0], x.shape[-1]
+
+    if chunk_size:
+        sq_diffs = np.zeros(x.shape[1:])
+        for index in np.ndindex(x.shape[:-1]):
+            sq_diffs[index[1:]] += fft_sq_diffs(np.asarray(x[index])[np.newaxis])
+    else:
+        sq_diffs = fft_sq_diffs(np.asarray(x))
+    t = np.arange(n_iters)
+
+    return sq_diffs / (m_chains * (n_iters - t))
+
+def fft_sq_diffs(x):
+    """ Sum over chains and iterations of the squared differences of x at every lag. """
+    n_iters = x.shape[-1]
+
+    # The variogram is invariant to shifts, so centre each chain for numerical stability
+    y = np.subtract(x, x.mean(axis=-1, dtype=np.float64, keepdims=True), dtype=np.float64)
+
+    # Zero pad to (at least) twice the chain length so the circular correlation doesn't wrap around
+    n_fft = next_fast_len(2 * n_iters, real=True)
+    f = rfft(y, n=n_fft, axis=-1)
+    # sum_j sum_i y[j, i] y[j, i+t], for every lag t
+    cross = irfft(f * f.conj(), n=n_fft, axis=-1)[..., :n_iters].sum(axis=0)
+
+    # Cumulative sums of squares give sum_i y[j, i]^2 over the head and tail of each lagged pair
+    sq_cumsum = np.cumsum((y**2).sum(axis=0), axis=-1)
+    sq_cumsum = np.concatenate((np.zeros(sq_cumsum.shape[:-1] + (1,)), sq_cumsum), axis=-1)
+    t = np.arange(n_iters)
+    head = sq_cumsum[..., n_iters - t]
+    tail = sq_cumsum[..., -1:] - sq_cumsum[..., t]
+
+    return head + tail - 2*cross
+
+def chunked_sq_diffs(x, t, chunk_size, dtype=None, compiled=False):
+    """ Sum over chains and iterations of (x[..., i+t] - x[..., i])^2, reading chunk_size
+    iterations of x at a time. The differences are held in working_dtype(x, dtype) and summed in
+    float64, or with compiled=True summed by sq_diffs_kernel without temporary arrays. """
+    m_chains, n_iters = x.shape[0], x.shape[-1]
+    sq_diffs = 0
+
+    for start in range(0, n_iters - t, chunk_size):
+        stop = min(start + chunk_size, n_iters - t)
+
+        if compiled:
+            # Each chunk, with the t draws after it, holds the lagged pairs starting in the chunk
+            chunk = np.asarray(x[..., start:stop+t]).reshape(m_chains, -1, stop - start + t)
+            sq_diffs += sq_diffs_kernel(chunk, t).reshape(x.shape[1:-1])
+            continue
+
+        lagged = np.subtract(x[..., start+t:stop+t], x[..., start:stop], dtype=working_dtype(x, dtype))
+        sq_diffs += np.square(lagged, out=lagged).sum(axis=(0, -1), dtype=np.float64)
+
+    return sq_diffs
+
+def sq_diffs_kernel(x, t):
+    """ Sum over chains and iterations of (x[j, p, i+t] - x[j, p, i])^2 for each parameter p of x,
+    shaped (chains, params, iters), without temporary arrays. Compiled when Numba is installed. """
+    m_chains, p_params, n_iters = x.shape
+    sq_diffs = np.zeros(p_params)
+
+    for p in range(p_params):
+        for j in range(m_chains):
+            for i in range(t, n_iters):
+                sq_diffs[p] += (x[j, p, i] - x[j, p, i-t])**2
+
+    return sq_diffs
+
+if numba is not None:
+    sq_diffs_kernel = numba.njit(cache=True)(sq_diffs_kernel)
+
+def my_gelman_rubin(x, chunk_size=None, dtype=None):
+    """ Estimate the marginal posterior variance. Vectorised implementation.
+
+    x has shape (chains, iters), or (chains, params, iters) to estimate the variance of every
+    parameter at once. If chunk_size is given, x is read chunk_size iterations at a time. See
+    mean_sq_dev for dtype.
+    """
+    m_chains, n_iters = x.shape[0], x.shape[-1]
+
+    if chunk_size:
+        moments = GelmanRubinAccumulator(m_chains, x.shape[1:-1])
+        for start in range(0, n_iters, chunk_size):
+            moments.update_block(np.asarray(x[..., start:start+chunk_size]), dtype)
+
+        return moments.post_var()
+
+    chain_means, chain_sq_devs = mean_sq_dev(x, dtype)
 
     # Calculate between-chain variance
-    B_over_n = ((np.mean(x, axis=1) - np.mean(x))**2).sum() / (m_chains - 1)
+    B_over_n = ((chain_means - np.mean(chain_means, axis=0))**2).sum(axis=0) / (m_chains - 1)
 
     # Calculate within-chain variances
-    W = ((x - x.mean(axis=1, keepdims=True))**2).sum() / (m_chains*(n_iters - 1))
+    W = chain_sq_devs.sum(axis=0) / (m_chains*(n_iters - 1))
 
     # (over) estimate of variance
     s2 = W * (n_iters - 1) / n_iters + B_over_n
 
     return s2
 
+def mean_sq_dev(x, dtype=None):
+    """ Means of x over its last axis, and sums of squared deviations about them.
+
+    The deviations are held in working_dtype(x, dtype), so float32 draws make float32
+    temporaries, but both sums are accumulated in float64.
+    """
+    work = working_dtype(x, dtype)
+    means = np.mean(x, axis=-1, dtype=np.float64)
+    rounded = means.astype(work)
+
+    deviations = np.subtract(x, rounded[..., np.newaxis], dtype=work)
+    sq_devs = np.square(deviations, out=deviations).sum(axis=-1, dtype=np.float64)
+
+    # Correct for rounding the means to the working type
+    return means, sq_devs - x.shape[-1] * (means - rounded)**2
+
+def working_dtype(x, dtype=None):
+    """ Floating point type for temporary arrays made from x: dtype if given, otherwise the type of
+    x (float64 for integer draws). """
+    return np.result_type(x.dtype if dtype is None else np.dtype(dtype), np.float32)
+
+def batch_means_ESS(x, batch_size=None, overlapping=False, post_var=None):
+    """ Compute the effective sample size of estimand of interest from a batch means estimate of
+    the asymptotic variance, in O(m n) time. x has shape (chains, iters) or (chains, params, iters).
+    See batch_means_var for batch_size and overlapping. """
+    m_chains, n_iters = x.shape[0], x.shape[-1]
+
+    if post_var is None:
+        post_var = my_gelman_rubin(x)
+
+    ess = (m_chains * n_iters * post_var / batch_means_var(x, batch_size, overlapping)).astype(int)
+
+    return int(ess) if ess.ndim == 0 else ess
+
+def batch_means_var(x, batch_size=None, overlapping=False):
+    """ Estimate the asymptotic variance of the mean of the chains of x, shaped (chains, ..., iters).
+
+    With overlapping=False the chains are cut into consecutive batches of batch_size draws
+    (floor(sqrt(n)) by default), otherwise every window of batch_size consecutive draws is used.
+    All batch means are found from a single cumulative sum. Batch means are taken about the pooled
+    mean of all chains, as in the replicated batch means of Vats and Knudson (2021), so chains
+    which disagree inflate the variance, just as they inflate my_gelman_rubin.
+    """
+    m_chains, n_iters = x.shape[0], x.shape[-1]
+    b = batch_size or int(np.sqrt(n_iters))
+
+    # Centre on the pooled mean, then prepend a zero to the cumulative sums
+    y = np.subtract(x, x.mean(axis=(0, -1), dtype=np.float64, keepdims=True), dtype=np.float64)
+    y_cumsum = np.cumsum(y, axis=-1)
+    y_cumsum = np.concatenate((np.zeros(y_cumsum.shape[:-1] + (1,)), y_cumsum), axis=-1)
+
+    if overlapping:
+        batch_means = (y_cumsum[..., b:] - y_cumsum[..., :-b]) / b
+        sigma2 = (n_iters * b / ((n_iters - b) * (n_iters - b + 1)) *
+                  (batch_means**2).sum(axis=-1)).mean(axis=0)
+    else:
+        a_batches = n_iters // b
+        batch_means = np.diff(y_cumsum[..., :a_batches*b+1:b], axis=-1) / b
+        sigma2 = b / (m_chains*a_batches - 1) * (batch_means**2).sum(axis=(0, -1))
+
+    return sigma2
+
+def multi_ESS(x, batch_size=None):
+    """ Multivariate effective sample size of Vats, Flegal and Jones (2019) for x, shaped
+    (chains, params, iters).
+
+    Compares the generalised variance of the pooled draws with that of a batch means estimate of
+    the asymptotic covariance, with batches of batch_size draws (floor(sqrt(n)) by default). As in
+    batch_means_var, batch means are taken about the pooled mean, so chains which disagree inflate
+    both covariances. Both are found in single vectorised passes over all parameters.
+
+    As Vats, Flegal and Jones require, each chain must have more batches than parameters, a > p;
+    with fewer the batch means covariance is (near) singular and the ESS hugely inflated. The
+    default batch size is reduced until this holds, and a ValueError raised if it can't, or if
+    either covariance is singular.
+    """
+    m_chains, p_params, n_iters = x.shape
+
+    # Fewest batches per chain for a well-conditioned batch means covariance
+    min_batches = p_params + 1
+    b = batch_size or min(int(np.sqrt(n_iters)), n_iters // min_batches)
+    if b < 1 or n_iters // b < min_batches:
+        raise ValueError("Too few batches for {} parameters: need at least {} batches per chain of "
+                         "{} draws".format(p_params, min_batches, n_iters))
+    a_batches = n_iters // b
+
+    # Sample covariance of the pooled draws
+    z = np.subtract(x, x.mean(axis=(0, 2), dtype=np.float64, keepdims=True), dtype=np.float64)
+    sample_cov = np.einsum('jpi,jqi->pq', z, z) / (m_chains*n_iters - 1)
+
+    # Batch means covariance, from deviations of every chain's batch means about the pooled mean
+    batch_means = z[..., :a_batches*b].reshape(m_chains, p_params, a_batches, b).mean(axis=-1)
+    asymp_cov = b * np.einsum('jpk,jqk->pq', batch_means, batch_means) / (m_chains*a_batches - 1)
+
+    # Ratio of determinants, computed on the log scale to avoid overflow in high dimensions
+    (sample_sign, sample_log_det), (asymp_sign, asymp_log_det) = map(np.linalg.slogdet,
+                                                                     (sample_cov, asymp_cov))
+    if sample_sign <= 0 or asymp_sign <= 0:
+        raise ValueError("Covariance matrix is singular, so the multivariate ESS is undefined")
+    log_det_ratio = sample_log_det - asymp_log_det
+
+    return int(m_chains * n_iters * np.exp(log_det_ratio / p_params))
+
+def split_chains(x):
+    """ Split each chain of x, shaped (chains, ..., iters), into its first and second halves,
+    dropping the middle draw of odd length chains. """
+    half = x.shape[-1] // 2
+
+    return np.concatenate((x[..., :half], x[..., x.shape[-1] - half:]), axis=0)
+
+def rank_diagnostics(x, method='fft'):
+    """ Rank-normalised split R-hat, bulk ESS and tail ESS (Vehtari et al., 2021).
+
+    x has shape (chains, iters), or (chains, params, iters) for every parameter at once. The draws,
+    and the draws folded about their median, are ranked in a single pass, and one autocorrelation
+    pass, truncated by Geyer's initial monotone sequence, covers the bulk and both 5% and 95%
+    quantile indicators. Returns R-hat, bulk ESS and tail ESS.
+    """
+    x = split_chains(np.asarray(x))
+    m_chains, n_iters = x.shape[0], x.shape[-1]
+    n_draws = m_chains * n_iters
+    folded = np.abs(x - np.median(x, axis=(0, -1), keepdims=True))
+
+    # Rank the draws and folded draws of each parameter, pooling chains and iterations
+    pooled = np.moveaxis(np.stack((x, folded), axis=1), 0, -2)
+    ranks = rankdata(pooled.reshape(pooled.shape[:-2] + (n_draws,)), axis=-1)
+    ranks = np.moveaxis(ranks.reshape(pooled.shape), -2, 0)
+
+    # Normal scores of the ranks, shaped (chains, 2, ..., iters)
+    z = norm.ppf((ranks - 3/8) / (n_draws + 1/4))
+    within = z.var(axis=-1, ddof=1).mean(axis=0)
+    rhat = np.sqrt(my_gelman_rubin(z) / within).max(axis=0)
+
+    # Indicators of draws at or below the 5% and 95% quantiles, found from the ranks
+    tails = [ranks[:, 0] <= np.floor(q * (n_draws - 1)) + 1 for q in (0.05, 0.95)]
+    ess = my_ESS(np.stack([z[:, 0]] + tails, axis=1).astype(float), method, monotone=True)
+
+    return rhat, ess[0], np.minimum(ess[1], ess[2])
+
+class GelmanRubinAccumulator:
+    """ Running estimate of the marginal posterior variance, updated as draws are made.
+
+    Keeps Welford's running mean and sum of squared deviations (M2) of each chain, so the
+    posterior variance and R-hat are available at any iteration without revisiting old draws.
+    """
+
+    def __init__(self, m_chains, shape=()):
+        self.n_iters = 0
+        self.mean = np.zeros((m_chains,) + tuple(shape))
+        self.M2 = np.zeros((m_chains,) + tuple(shape))
+
+    def update(self, draws):
+        """ Add a single draw from every chain, shaped (chains, ...). """
+        self.n_iters += 1
+        delta = draws - self.mean
+        self.mean += delta / self.n_iters
+        self.M2 += delta * (draws - self.mean)
+
+    def update_block(self, block, dtype=None):
+        """ Add a block of draws from every chain, shaped (chains, ..., iters). See mean_sq_dev for
+        dtype. """
+        k_iters = block.shape[-1]
+        if k_iters == 0:
+            return
+
+        block_mean, block_M2 = mean_sq_dev(block, dtype)
+
+        # Chan et al.'s rule for combining the moments of two samples
+        n_total = self.n_iters + k_iters
+        delta = block_mean - self.mean
+        self.mean += delta * k_iters / n_total
+        self.M2 += block_M2 + delta**2 * self.n_iters * k_iters / n_total
+        self.n_iters = n_total
+
+    def within(self):
+        """ Within-chain variance W. """
+        return self.M2.sum(axis=0) / (self.mean.shape[0] * (self.n_iters - 1))
+
+    def post_var(self):
+        """ (Over) estimate of the marginal posterior variance, as my_gelman_rubin. """
+        m_chains, n_iters = self.mean.shape[0], self.n_iters
+        B_over_n = ((self.mean - self.mean.mean(axis=0))**2).sum(axis=0) / (m_chains - 1)
+
+        return self.within() * (n_iters - 1) / n_iters + B_over_n
+
+    def rhat(self):
+        """ Potential scale reduction factor, sqrt(var+ / W). """
+        return np.sqrt(self.post_var() / self.within())
+
+class IncrementalESS:
+    """ Effective sample size of chains which are extended block by block.
+
+    Caches the sum of squared differences at each lag t = 1, ..., max_lag, so appending a block of
+    k draws only costs O(m k max_lag), rather than recomputing every variogram from scratch. Only
+    the last max_lag draws of each chain are kept. Agrees with my_ESS whenever the autocorrelations
+    are truncated before max_lag; cut_off tells which parameters that holds for.
+    """
+
+    def __init__(self, m_chains, shape=(), max_lag=1000):
+        self.max_lag = max_lag
+        self.n_iters = 0
+        self.sq_diffs = np.zeros(tuple(shape) + (max_lag,))
+        self.tail = np.zeros((m_chains,) + tuple(shape) + (0,))
+        self.moments = GelmanRubinAccumulator(m_chains, shape)
+
+    def update_block(self, block):
+        """ Append a block of draws from every chain, shaped (chains, ..., iters). """
+        n_tail = self.tail.shape[-1]
+        z = np.concatenate((self.tail, block), axis=-1)
+
+        # Add the squared differences of each lagged pair ending in the new block
+        for t in range(1, min(self.max_lag, z.shape[-1] - 1) + 1):
+            start = max(n_tail, t)
+            self.sq_diffs[..., t-1] += ((z[..., start:] - z[..., start-t:-t])**2).sum(axis=(0, -1))
+
+        self.tail = z[..., -self.max_lag:].copy()
+        self.n_iters += block.shape[-1]
+        self.moments.update_block(block)
+
+    def rho(self):
+        """ Estimated autocorrelations at lags t = 0, ..., min(max_lag, n-1). """
+        m_chains, n_iters = self.tail.shape[0], self.n_iters
+        t = np.arange(1, min(self.max_lag, n_iters - 1) + 1)
+        variograms = self.sq_diffs[..., t-1] / (m_chains * (n_iters - t))
+        post_var = self.moments.post_var()
+
+        rho = np.ones(np.shape(post_var) + (len(t) + 1,))
+        rho[..., 1:] = 1 - variograms / (2 * np.asarray(post_var)[..., np.newaxis])
+
+        return rho
+
+    def ess(self, monotone=False):
+        """ Current effective sample size of each parameter. Only an overestimate for parameters
+        which are not cut_off. """
+        rho_sum = autocorr_sum(self.rho(), monotone)
+        ess = (self.tail.shape[0] * self.n_iters / (1 + 2*rho_sum)).astype(int)
+
+        return int(ess) if ess.ndim == 0 else ess
+
+    def cut_off(self, monotone=False):
+        """ Whether the autocorrelation sum of each parameter was truncated within max_lag, or
+        covers every lag, so that its ess() agrees with my_ESS. """
+        _, cut_off = autocorr_sum(self.rho(), monotone, return_cutoff=True)
+
+        return cut_off | (self.n_iters - 1 <= self.max_lag)
+
+def autocorr_sum(rho, monotone=False, return_cutoff=False):
+    """ Sum autocorrelations rho, shaped (..., lags), over lags 1, ..., T+2 where T is the first odd
+    lag for which rho[T+1] + rho[T+2] is negative, or over every lag if there is no such T.
+
+    With monotone=True the sum is instead Geyer's initial monotone sequence estimator, as in
+    Vehtari et al. (2021): the pairs rho[t] + rho[t+1] (t even, from lag 0) before the first
+    negative pair after rho[0] + rho[1], each replaced by the minimum of the pairs up to it, less
+    rho[0] = 1.
+
+    With return_cutoff=True, whether each sum was truncated by a negative pair, rather than running
+    out of lags, is also returned.
+    """
+    n_lags = rho.shape[-1]
+    # Geyer's pairs start at lag 0, the others at lag 1
+    first = 0 if monotone else 1
+    n_pairs = (n_lags - first) // 2
+    pairs = rho[..., first:first+2*n_pairs:2] + rho[..., first+1:first+2*n_pairs:2]
+
+    # Index of the first negative pair of each parameter, n_pairs if there is none
+    negative = np.concatenate((pairs < 0, np.ones(pairs.shape[:-1] + (1,), dtype=bool)), axis=-1)
+    if monotone:
+        # The pair of lags 0 and 1 is always kept
+        negative[..., 0] = n_pairs == 0
+    first_negative = negative.argmax(axis=-1)
+
+    cut_off = first_negative < n_pairs
+
+    if monotone:
+        before = np.arange(n_pairs) < first_negative[..., np.newaxis]
+        rho_sum = np.where(before, np.minimum.accumulate(pairs, axis=-1), 0).sum(axis=-1) - 1
+    else:
+        # Sum up to and including the first negative pair, or every lag if there is none
+        stop = np.where(cut_off, 2*first_negative + 3, n_lags)
+        lags = np.arange(n_lags)
+        included = (lags >= 1) & (lags < stop[..., np.newaxis])
+        rho_sum = np.where(included, rho, 0).sum(axis=-1)
+
+    if return_cutoff:
+        return rho_sum, cut_off
+
+    return rho_sum
+
 def ESS(x):
     """ Compute the effective sample size of estimand of interest. PyMC's implementation. """
     m_chains, n_iters = x.shape
@@ -86,7 +554,618 @@ def gelman_rubin(x):
 
     return s2
 
+def gaussian_log_target(mu, data, scale=1):
+    """ Log-likelihood of data ~ N(mu, scale^2) for a batch of states mu, shaped (chains, params).
+    data has shape (params,) or (observations, params). """
+    resid = (np.atleast_2d(data) - mu[:, np.newaxis, :]) / scale
+    n_terms = resid.shape[1] * resid.shape[2]
+
+    return -0.5*(resid**2).sum(axis=(1, 2)) - n_terms*(np.log(scale) + 0.5*np.log(2*np.pi))
+
+def student_t_log_target(mu, data, df, scale=1):
+    """ Log-likelihood of data ~ t_df(mu, scale) for a batch of states mu, shaped (chains, params).
+    data has shape (params,) or (observations, params). """
+    resid = (np.atleast_2d(data) - mu[:, np.newaxis, :]) / scale
+    n_terms = resid.shape[1] * resid.shape[2]
+    log_norm = lgamma((df + 1) / 2) - lgamma(df / 2) - 0.5*np.log(df*np.pi) - np.log(scale)
+
+    return -0.5*(df + 1)*np.log1p(resid**2 / df).sum(axis=(1, 2)) + n_terms*log_norm
+
+# Log-targets available to make_log_target, by name
+LOG_TARGETS = {'gaussian': gaussian_log_target, 'student_t': student_t_log_target}
+
+def register_log_target(name, log_target):
+    """ Register log_target(mu, **params), which must return the log-density of each state in the
+    batch mu, shaped (chains, params), for use with make_log_target. """
+    LOG_TARGETS[name] = log_target
+
+def make_log_target(name, **params):
+    """ Bind params (e.g. the observed data) to the log-target registered as name. """
+    if name not in LOG_TARGETS:
+        raise ValueError("Unknown log-target '{}', expected one of {}".format(name, list(LOG_TARGETS)))
+
+    return partial(LOG_TARGETS[name], **params)
+
+class RWMH:
+    """ Random walk Metropolis-Hastings sampler, advancing every chain together in one NumPy step.
+
+    log_target is called with a batch of states, shaped (chains, params), and must return the
+    log-density of each, e.g. one made by make_log_target. mu_init holds the initial state of each
+    chain, shaped (chains, params). Random numbers are drawn from np.random.default_rng(seed),
+    one block of steps at a time, so a run is exactly reproducible for a given seed and sequence
+    of block lengths.
+
+    The sampler keeps its chains' states, random number generator and acceptance counts between
+    calls, so sample() can stream blocks of draws to disk, diagnostics or plots without the whole
+    chains ever being held in memory.
+
+    With adapt=True, or an AdaptiveProposal starting from rw_cov, the proposal covariance and
+    scale are adapted as the chains run (Haario et al., 2001).
+
+    With backend='numba', and a Gaussian log_target made by make_log_target, the steps of each
+    block run in a compiled loop without temporary arrays. Otherwise, if Numba is not installed or
+    the proposal is adapted, the NumPy steps are used.
+
+    Throughput, acceptance and timings are recorded in stats, a SamplerStats with the given window,
+    and callback, if given, is called with the sampler after every block.
+    """
+
+    def __init__(self, log_target, mu_init, rw_cov, seed=None, block_size=1000, backend='numpy',
+                 adapt=False, callback=None, window=1000):
+        self.log_target = log_target
+        self.block_size = block_size
+        self.callback = callback
+        self.rng = np.random.default_rng(seed)
+        self.mu_cur = np.array(mu_init, dtype=float)
+        self.stats = SamplerStats(len(self.mu_cur), window)
+
+        start_time, start_cpu = time.perf_counter(), time.process_time()
+        self.ll_cur = log_target(self.mu_cur)
+        self.stats.log_target_time += time.perf_counter() - start_time
+        self.stats.wall_time += time.perf_counter() - start_time
+        self.stats.cpu_time += time.process_time() - start_cpu
+        self.stats.log_target_evals += len(self.mu_cur)
+
+        # Factorise the proposal covariance once, rather than on every draw
+        self.rw_chol = np.linalg.cholesky(rw_cov)
+        self.adapt = AdaptiveProposal(rw_cov) if adapt is True else adapt
+
+        self.compiled = (backend == 'numba' and numba is not None and not self.adapt and
+                         isinstance(log_target, partial) and log_target.func is gaussian_log_target
+                         and not log_target.args)
+        if self.compiled:
+            self.data = np.atleast_2d(np.asarray(log_target.keywords['data'], dtype=float))
+            self.scale = float(log_target.keywords.get('scale', 1))
+
+    def sample(self, n_steps, dtype=np.float64, burn=0, thin=1):
+        """ Generator yielding the draws of the next n_steps steps, in blocks of type dtype shaped
+        (chains, params, block_size), the last of which may be shorter.
+
+        The first burn steps are taken beforehand and discarded, and of the n_steps steps only
+        every thin-th draw, starting with the first, is yielded.
+        """
+        runs, n_params = self.mu_cur.shape
+        scratch = np.empty((runs, n_params, self.block_size), dtype=dtype)
+
+        # Burn-in draws are written over the same block and discarded
+        for start in range(0, burn, self.block_size):
+            self.run_block(scratch[..., :min(self.block_size, burn - start)])
+
+        for start in range(0, n_steps, self.block_size):
+            n_block = min(self.block_size, n_steps - start)
+
+            if thin == 1:
+                block = np.empty((runs, n_params, n_block), dtype=dtype)
+                self.run_block(block)
+            else:
+                # Keep the draws whose number of steps since burn-in is a multiple of thin
+                self.run_block(scratch[..., :n_block])
+                block = scratch[..., -start % thin:n_block:thin].copy()
+
+            if block.shape[-1]:
+                yield block
+
+    def run(self, n_steps, burn=0, thin=1, keep=None, dtype=np.float64, max_lag=None):
+        """ Take burn + n_steps steps, keeping every thin-th draw after burn-in (see sample).
+
+        Returns the kept draws, shaped (chains, params, ceil(n_steps / thin)), or with keep=N a
+        RingBuffer holding only the last N of them, with running statistics of them all.
+        """
+        runs, n_params = self.mu_cur.shape
+
+        if keep:
+            store = RingBuffer(runs, n_params, keep, dtype, max_lag)
+        else:
+            store = np.empty((runs, n_params, -(-n_steps // thin)), dtype=dtype)
+
+        n_kept = 0
+        for block in self.sample(n_steps, dtype, burn, thin):
+            if keep:
+                store.update_block(block)
+            else:
+                store[..., n_kept:n_kept + block.shape[-1]] = block
+            n_kept += block.shape[-1]
+
+        return store
+
+    def run_until(self, target_ess, max_time=None, max_steps=None, rhat_max=1.01, params=None,
+                  burn=0, thin=1, keep=None, dtype=np.float64, max_lag=1000):
+        """ Sample until every monitored parameter has an ESS of at least target_ess and R-hat of at
+        most rhat_max, or until max_time seconds or max_steps steps (after burn-in) have passed.
+
+        params indexes the monitored parameters, by default all. After each block, their ESS is
+        updated by an IncrementalESS with the given max_lag and their R-hat by its running moments.
+        A parameter whose autocorrelations are not truncated within max_lag has only an upper bound
+        on its ESS, so never counts as reached; raise max_lag for slowly mixing chains. Returns the
+        kept draws, as run, and whether the targets were reached.
+        """
+        runs, n_params = self.mu_cur.shape
+        params = np.arange(n_params) if params is None else np.atleast_1d(params)
+        monitor = IncrementalESS(runs, (len(params),), max_lag)
+
+        if keep:
+            store = RingBuffer(runs, n_params, keep, dtype)
+        else:
+            store = []
+
+        start_time = time.perf_counter()
+        reached = False
+
+        for block in self.sample(max_steps or sys.maxsize, dtype, burn, thin):
+            if keep:
+                store.update_block(block)
+            else:
+                store.append(block)
+            monitor.update_block(block[:, params])
+
+            if monitor.n_iters > 1:
+                reached = ((monitor.ess() >= target_ess).all() and monitor.cut_off().all() and
+                           (monitor.moments.rhat() <= rhat_max).all())
+            if reached or (max_time is not None and time.perf_counter() - start_time > max_time):
+                break
+
+        if not keep:
+            store = np.concatenate(store, axis=-1) if store else np.empty((runs, n_params, 0), dtype)
+
+        return store, reached
+
+    @property
+    def n_steps(self):
+        """ Number of steps taken so far. """
+        return self.stats.n_steps
+
+    @property
+    def accept(self):
+        """ Number of accepted proposals in each chain so far. """
+        return self.stats.accepted
+
+    def run_block(self, output):
+        """ Take one block of steps, writing the states of the chains after each into output,
+        shaped (chains, params, steps). """
+        n_block = output.shape[-1]
+        runs, n_params = self.mu_cur.shape
+        start_time, start_cpu = time.perf_counter(), time.process_time()
+
+        # Generate the innovations and log-uniforms for a whole block of steps at once
+        innovations = self.rng.standard_normal((n_block, runs, n_params))
+        log_u = np.log(self.rng.uniform(size=(n_block, runs)))
+        rng_time = time.perf_counter() - start_time
+        if not self.adapt:
+            innovations = innovations @ self.rw_chol.T
+
+        # Whether each chain accepted its proposal at each step
+        accepted = np.empty((n_block, runs), dtype=bool)
+        log_target_time = 0.
+
+        if self.compiled:
+            gaussian_rwmh_kernel(self.data, self.scale, self.mu_cur, self.ll_cur, innovations, log_u,
+                                 np.asarray(output), accepted)
+        else:
+            mu_cur, ll_cur, adapt = self.mu_cur, self.ll_cur, self.adapt
+
+            for k in range(n_block):
+                # Propose new values for every chain
+                mu_prop = mu_cur + (adapt.propose(innovations[k]) if adapt else innovations[k])
+                # Compute log-likelihood of proposed values
+                log_target_start = time.perf_counter()
+                ll_prop = self.log_target(mu_prop)
+                log_target_time += time.perf_counter() - log_target_start
+
+                # Accept or reject proposals
+                accepted[k] = ll_prop - ll_cur > log_u[k]
+                mu_cur = np.where(accepted[k, :, np.newaxis], mu_prop, mu_cur)
+                ll_cur = np.where(accepted[k], ll_prop, ll_cur)
+
+                if adapt:
+                    adapt.update(mu_cur, accepted[k])
+
+                # Record current state of chains
+                output[:, :, k] = mu_cur
+
+            self.mu_cur, self.ll_cur = mu_cur, ll_cur
+
+        self.stats.record_block(accepted, time.perf_counter() - start_time, log_target_time, rng_time,
+                                time.process_time() - start_cpu)
+
+        if self.callback is not None:
+            self.callback(self)
+
+class SamplerStats:
+    """ Throughput and acceptance counters of an RWMH sampler.
+
+    Counts each chain's accepted proposals, overall and over the last window steps, and the wall
+    clock and CPU time spent taking steps, with the parts of the wall time spent evaluating the
+    log-target and generating random numbers. A sampler's chains advance together, so they share
+    its timings. Time inside a compiled block cannot be split up, so it only counts towards the
+    wall time.
+    """
+
+    def __init__(self, m_chains, window=1000):
+        self.n_steps = 0
+        self.accepted = np.zeros(m_chains, dtype=int)
+        self.recent = np.zeros((window, m_chains), dtype=bool)
+
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.log_target_time = 0.
+        self.rng_time = 0.
+        self.log_target_evals = 0
+
+    def record_block(self, accepted, wall_time, log_target_time, rng_time, cpu_time=0.):
+        """ Add a block of steps, given whether each chain accepted its proposal at each step,
+        shaped (steps, chains), and the time they took. """
+        n_block, window = len(accepted), len(self.recent)
+
+        # Acceptances are written cyclically, so row i holds those of the last step i mod window
+        steps = np.arange(max(n_block - window, 0), n_block)
+        self.recent[(self.n_steps + steps) % window] = accepted[steps]
+
+        self.n_steps += n_block
+        self.accepted += accepted.sum(axis=0)
+        self.log_target_evals += accepted.size
+
+        self.wall_time += wall_time
+        self.cpu_time += cpu_time
+        self.log_target_time += log_target_time
+        self.rng_time += rng_time
+
+    def draws_per_second(self):
+        """ Draws made per second of wall clock time by each chain. """
+        return np.full(len(self.accepted), self.n_steps / self.wall_time if self.wall_time else 0.)
+
+    def accept_rate(self):
+        """ Acceptance rate of each chain over all steps. """
+        return self.accepted / max(self.n_steps, 1)
+
+    def window_accept_rate(self):
+        """ Acceptance rate of each chain over the last window steps. """
+        return self.recent[:max(min(self.n_steps, len(self.recent)), 1)].mean(axis=0)
+
+    def to_dict(self):
+        """ Counters as a dict of plain Python numbers and lists. """
+        return {
+            'chains': len(self.accepted),
+            'steps': self.n_steps,
+            'window': len(self.recent),
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'log_target_time': self.log_target_time,
+            'rng_time': self.rng_time,
+            'log_target_evals': self.log_target_evals,
+            'draws_per_second': self.draws_per_second().tolist(),
+            'accept_rate': self.accept_rate().tolist(),
+            'window_accept_rate': self.window_accept_rate().tolist(),
+        }
+
+    def to_json(self, **kwargs):
+        """ Counters as a JSON string, passing kwargs on to json.dumps. """
+        return json.dumps(self.to_dict(), **kwargs)
+
+    @classmethod
+    def concatenate(cls, stats):
+        """ Counters of the chains of several samplers, all taking the same steps side by side (e.g.
+        parallel_rwmh's workers), in order. As the samplers ran concurrently the wall time is the
+        longest of theirs, while the other times and the log-target evaluations are summed. """
+        merged = cls(0, len(stats[0].recent))
+        merged.n_steps = stats[0].n_steps
+        merged.accepted = np.concatenate([group.accepted for group in stats])
+        merged.recent = np.concatenate([group.recent for group in stats], axis=1)
+
+        merged.wall_time = max(group.wall_time for group in stats)
+        merged.cpu_time = sum(group.cpu_time for group in stats)
+        merged.log_target_time = sum(group.log_target_time for group in stats)
+        merged.rng_time = sum(group.rng_time for group in stats)
+        merged.log_target_evals = sum(group.log_target_evals for group in stats)
+
+        return merged
+
+def efficiency_report(draws, stats, method='fft'):
+    """ Pair the ESS of draws, shaped (chains, params, iters), with the time and log-target
+    evaluations spent making them, as recorded by the SamplerStats stats returned by rwmh or
+    parallel_rwmh.
+
+    Gives the ESS of each parameter over all chains, and over each chain alone, per second of
+    wall clock and of CPU time and per log-target evaluation. The chains of a sampler advance
+    together, so each chain alone is charged the sampler's whole time but only its share of the
+    evaluations. Returns a dict of plain Python numbers and lists, ready for json.dumps.
+    """
+    m_chains = draws.shape[0]
+    ess = np.asarray(my_ESS(draws, method))
+
+    # A chain alone has no between-chain variance, so its own variance estimates the posterior's
+    chain_ess = np.stack([my_ESS(draws[j:j+1], method,
+                                 post_var=np.var(draws[j], axis=-1, dtype=np.float64))
+                          for j in range(m_chains)])
+
+    def rates(ess, log_target_evals):
+        return {
+            'ess': ess.tolist(),
+            'ess_per_second': (ess / stats.wall_time).tolist(),
+            'ess_per_cpu_second': (ess / stats.cpu_time).tolist(),
+            'ess_per_eval': (ess / log_target_evals).tolist(),
+        }
+
+    return {
+        'chains': m_chains,
+        'iters': draws.shape[-1],
+        'wall_time': stats.wall_time,
+        'cpu_time': stats.cpu_time,
+        'log_target_evals': stats.log_target_evals,
+        'pooled': rates(ess, stats.log_target_evals),
+        'per_chain': rates(chain_ess, stats.log_target_evals / m_chains),
+    }
+
+class RingBuffer:
+    """ Store of the last size draws of every chain, shaped (chains, params, size).
+
+    Running Gelman-Rubin moments, and with max_lag an IncrementalESS, cover every draw ever added,
+    so memory scales with the draws kept rather than the draws made.
+    """
+
+    def __init__(self, m_chains, n_params, size, dtype=np.float64, max_lag=None):
+        self.buffer = np.zeros((m_chains, n_params, size), dtype=dtype)
+        self.n_draws = 0
+        self.moments = GelmanRubinAccumulator(m_chains, (n_params,))
+        self.ess = IncrementalESS(m_chains, (n_params,), max_lag) if max_lag else None
+
+    def update_block(self, block):
+        """ Add a block of draws from every chain, shaped (chains, params, iters). """
+        size = self.buffer.shape[-1]
+        k_iters = block.shape[-1]
+
+        self.moments.update_block(block)
+        if self.ess is not None:
+            self.ess.update_block(block)
+
+        # Only the last size draws of the block can survive, written cyclically after the newest
+        kept = block[..., -size:]
+        first = (self.n_draws + k_iters - kept.shape[-1]) % size
+        self.buffer[..., (first + np.arange(kept.shape[-1])) % size] = kept
+        self.n_draws += k_iters
+
+    def draws(self):
+        """ The draws kept, oldest first. """
+        size = self.buffer.shape[-1]
+        n_kept = min(self.n_draws, size)
+
+        return self.buffer[..., (self.n_draws - n_kept + np.arange(n_kept)) % size]
+
+def rwmh(log_target, mu_init, rw_cov, iters, seed=None, block_size=1000, output=None,
+         progress=None, backend='numpy', dtype=np.float64, adapt=False, callback=None):
+    """ Run an RWMH sampler for iters iterations, including the initial state.
+
+    See RWMH for the arguments. Returns the draws, shaped (chains, params, iters), and the
+    sampler's SamplerStats, which include the number of accepted proposals in each chain
+    (stats.accepted). The draws are written into output, if given, otherwise
+    into a new array of type dtype; the chains' states are always kept in float64. After every
+    block progress is set to the number of iterations recorded so far.
+    """
+    sampler = RWMH(log_target, mu_init, rw_cov, seed, block_size, backend, adapt, callback)
+    runs, n_params = sampler.mu_cur.shape
+
+    # Array to store output in
+    if output is None:
+        output = np.zeros([runs, n_params, iters], dtype=dtype)
+    output[:, :, 0] = sampler.mu_cur
+
+    for start in range(1, iters, block_size):
+        stop = min(start + block_size, iters)
+        sampler.run_block(output[:, :, start:stop])
+
+        if progress is not None:
+            progress[:] = stop
+
+    return output, sampler.stats
+
+class AdaptiveProposal:
+    """ Adaptive random walk proposal of Haario et al. (2001), with its scale tuned toward a target
+    acceptance rate.
+
+    The empirical mean and covariance of every chain's draws are kept with O(d^2) updates per
+    draw, and every refresh_every steps the proposal's Cholesky factor is recomputed from
+    2.38^2 / d times the covariance. At each step the log scale of the proposal moves toward
+    target_accept by a Robbins-Monro step of size steps^-decay, so adaptation diminishes.
+    """
+
+    def __init__(self, rw_cov, refresh_every=100, target_accept=0.234, decay=0.6, eps=1e-10):
+        n_params = len(rw_cov)
+        self.refresh_every, self.target_accept, self.decay = refresh_every, target_accept, decay
+        self.eps = eps
+
+        self.n_steps = 0
+        self.n_draws = 0
+        self.mean = np.zeros(n_params)
+        self.M2 = np.zeros((n_params, n_params))
+
+        self.log_scale = 0.
+        self.chol = np.linalg.cholesky(rw_cov)
+
+    def propose(self, z):
+        """ Innovations for a batch of standard normals z, shaped (chains, params). """
+        return np.exp(self.log_scale) * z @ self.chol.T
+
+    def update(self, states, accepted):
+        """ Add the current states of every chain, shaped (chains, params), and tune the scale
+        from whether each chain's proposal was accepted. """
+        self.n_steps += 1
+
+        # Rank-one update of the covariance for each chain's draw, combined as in Chan et al.
+        k_draws = len(states)
+        n_total = self.n_draws + k_draws
+        deviations = states - states.mean(axis=0)
+        delta = states.mean(axis=0) - self.mean
+        self.mean += delta * k_draws / n_total
+        self.M2 += deviations.T @ deviations + np.outer(delta, delta) * self.n_draws * k_draws / n_total
+        self.n_draws = n_total
+
+        self.log_scale += self.n_steps**-self.decay * (np.mean(accepted) - self.target_accept)
+
+        if not self.n_steps % self.refresh_every and self.n_draws > len(self.mean):
+            self.chol = np.linalg.cholesky(self.cov())
+
+    def cov(self):
+        """ Unscaled proposal covariance, 2.38^2 / d times the empirical covariance. """
+        n_params = len(self.mean)
+        return (2.38**2 / n_params * self.M2 / (self.n_draws - 1) +
+                self.eps * np.eye(n_params))
+
+def gaussian_rwmh_kernel(data, scale, mu_cur, ll_cur, innovations, log_u, output, accepted):
+    """ Run a block of RWMH steps for gaussian_log_target, updating mu_cur and ll_cur and filling
+    output and accepted, shaped (steps, chains), in place without temporary arrays. Compiled when
+    Numba is installed. """
+    n_block, runs, n_params = innovations.shape
+    log_norm = -data.size * (np.log(scale) + 0.5*np.log(2*np.pi))
+    mu_prop = np.empty(n_params)
+
+    for k in range(n_block):
+        for j in range(runs):
+            # Propose new values and compute their log-likelihood
+            ll_prop = log_norm
+            for p in range(n_params):
+                mu_prop[p] = mu_cur[j, p] + innovations[k, j, p]
+                for o in range(data.shape[0]):
+                    ll_prop -= 0.5 * ((data[o, p] - mu_prop[p]) / scale)**2
+
+            # Accept or reject proposal
+            accepted[k, j] = ll_prop - ll_cur[j] > log_u[k, j]
+            if accepted[k, j]:
+                mu_cur[j, :] = mu_prop
+                ll_cur[j] = ll_prop
+
+            # Record current state of chain
+            output[j, :, k] = mu_cur[j, :]
+
+if numba is not None:
+    gaussian_rwmh_kernel = numba.njit(cache=True)(gaussian_rwmh_kernel)
+
+class SharedOutput:
+    """ Output array, shaped (chains, params, iters), in a multiprocessing.shared_memory block.
+
+    Worker processes write draws straight into array, and record the number of iterations each
+    chain has completed in progress, so the parent can run diagnostics on draws() while sampling
+    continues without copying anything. Pickling a SharedOutput attaches to the same block by
+    name. The creating process should unlink() the block once it is finished with; array must
+    not be used after close().
+    """
+
+    def __init__(self, shape, dtype=float, name=None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        progress_bytes = self.shape[0] * np.dtype(np.int64).itemsize
+
+        if name is None:
+            size = progress_bytes + int(np.prod(self.shape)) * self.dtype.itemsize
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.progress = np.ndarray(self.shape[0], dtype=np.int64, buffer=self.shm.buf)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf,
+                                offset=progress_bytes)
+
+    def __reduce__(self):
+        return SharedOutput, (self.shape, self.dtype, self.shm.name)
+
+    def draws(self):
+        """ View of the iterations which every chain has completed. """
+        return self.array[..., :self.progress.min()]
+
+    def close(self):
+        """ Detach this process from the shared block. """
+        del self.progress, self.array
+        self.shm.close()
+
+    def unlink(self):
+        """ Close and free the shared block. """
+        self.close()
+        self.shm.unlink()
+
+def parallel_rwmh(log_target, mu_init, rw_cov, iters, output=None, n_workers=None, seed=None,
+                  block_size=1000, wait=True, backend='numpy', dtype=np.float64, adapt=False):
+    """ Run rwmh with the chains split into groups, one per worker process.
+
+    Each group draws from an independent stream spawned from np.random.SeedSequence(seed). Workers
+    write their draws straight into output, so no draws are pickled back to the parent. output is
+    either a SharedOutput, shaped (chains, params, iters), or the filename of a .npy file to
+    memory-map; by default a new SharedOutput is created. log_target must be picklable, e.g. one
+    made by make_log_target. A new output store holds draws of type dtype. With adapt, each
+    group of chains adapts its own proposal (see rwmh).
+
+    Returns output and the workers' SamplerStats, combined by SamplerStats.concatenate. With
+    wait=False it returns immediately, with the workers' futures in place of the stats, so that
+    diagnostics can be run on output.draws() while sampling continues.
+    """
+    mu_init = np.array(mu_init, dtype=float)
+    runs, n_params = mu_init.shape
+    n_workers = min(n_workers or os.cpu_count(), runs)
+
+    if output is None:
+        output = SharedOutput((runs, n_params, iters), dtype)
+    elif isinstance(output, str):
+        np.lib.format.open_memmap(output, mode='w+', dtype=dtype, shape=(runs, n_params, iters)).flush()
+
+    groups = np.array_split(np.arange(runs), n_workers)
+    seeds = np.random.SeedSequence(seed).spawn(n_workers)
+
+    pool = ProcessPoolExecutor(n_workers)
+    futures = [pool.submit(rwmh_worker, output, group[0], log_target, mu_init[group], rw_cov, iters,
+                           group_seed, block_size, backend, adapt)
+               for group, group_seed in zip(groups, seeds)]
+    pool.shutdown(wait=wait)
+
+    if not wait:
+        return output, futures
+
+    stats = SamplerStats.concatenate([future.result() for future in futures])
+
+    if isinstance(output, str):
+        output = np.load(output, mmap_mode='r+')
+
+    return output, stats
+
+def rwmh_worker(output, start, log_target, mu_init, rw_cov, iters, seed, block_size, backend,
+                adapt):
+    """ Run a group of chains in a worker process, writing them to chains start, start + 1, ... of
+    output, a SharedOutput or the filename of a .npy file. Returns the group's SamplerStats. """
+    chains = slice(start, start + len(mu_init))
+
+    if isinstance(output, str):
+        array = np.load(output, mmap_mode='r+')
+        _, stats = rwmh(log_target, mu_init, rw_cov, iters, seed, block_size, array[chains],
+                        backend=backend, adapt=adapt)
+        array.flush()
+    else:
+        _, stats = rwmh(log_target, mu_init, rw_cov, iters, seed, block_size,
+                        output.array[chains], output.progress[chains], backend, adapt=adapt)
+        output.close()
+
+    return stats
+
 if __name__ == "__main__":
+    import timeit
+
+    import matplotlib.pyplot as plt
+    plt.style.use('seaborn')
+
     # Observed data
     data = np.zeros(2)
 
@@ -97,32 +1176,13 @@ if __name__ == "__main__":
     # Initial values
     mu_cur = np.array([[2.5, 2.5], [2.5, -2.5], [-2.5, 2.5], [-2.5, -2.5]])
 
-    # Array to store output in
-    output = np.zeros([runs, 2, iters])
-    output[:, :, 0] = mu_cur
     # Innovation size
     rw_cov = np.eye(2)
 
-    for j in range(runs):
-        ll_cur = norm.logpdf(data, mu_cur[j], 1).sum()
-        accept = 0
-
-        for i in range(1, iters):
-            # Propose new values
-            mu_prop = np.random.multivariate_normal(mu_cur[j], rw_cov)
-            # Compute log-likelihood of proposed values
-            ll_prop = norm.logpdf(data, mu_prop, 1).sum()
+    output, stats = rwmh(make_log_target('gaussian', data=data), mu_cur, rw_cov, iters)
 
-            # Accept or reject proposal
-            if ll_prop - ll_cur > np.log(np.random.uniform()):
-                mu_cur[j] = mu_prop.copy()
-                ll_cur = ll_prop
-                accept += 1
-
-            # Record current state of chain
-            output[j, :, i] = mu_cur[j]
-
-        print("Chain {} acceptance rate was: {:.2f}%".format(j, accept / (iters - 1) * 100))
+    for j in range(runs):
+        print("Chain {} acceptance rate was: {:.2f}%".format(j, stats.accepted[j] / (iters - 1) * 100))
 
     # Plot walk around parameter space
     fig, ax = plt.subplots(1, 1)
@@ -150,5 +1210,25 @@ if __name__ == "__main__":
 
     fig.tight_layout()
 
-    ipython.magic('timeit ESS(output[:, 0, :])')
-    ipython.magic('timeit my_ESS(output[:, 0, :])')
+    # Estimate the posterior variance and ESS of every parameter at once
+    post_var = my_gelman_rubin(output)
+    print("Posterior variances: {}, effective sample sizes: {}".format(post_var,
+                                                                     my_ESS(output, post_var=post_var)))
+
+    # Chains which disagree must lower the batch means ESS, as they lower my_ESS
+    shifted = output + np.arange(runs)[:, np.newaxis, np.newaxis]
+    bm_ess, shifted_bm_ess = batch_means_ESS(output), batch_means_ESS(shifted)
+    assert (shifted_bm_ess < bm_ess).all()
+    print("Batch means ESS: {}, with the chains shifted apart: {}".format(bm_ess, shifted_bm_ess))
+    multi_ess, shifted_multi_ess = multi_ESS(output), multi_ESS(shifted)
+    assert shifted_multi_ess < multi_ess
+    print("Multivariate ESS: {}, with the chains shifted apart: {}".format(multi_ess,
+                                                                          shifted_multi_ess))
+
+    # Effective draws per second and per log-target evaluation, the sampler's efficiency
+    print(json.dumps(efficiency_report(output, stats), indent=2))
+
+    # Compare the speed of PyMC's and my ESS (see benchmark.py for a fuller comparison)
+    for name, ess in [('ESS', ESS), ('my_ESS', my_ESS)]:
+        n_loops, total = timeit.Timer(lambda: ess(output[:, 0, :])).autorange()
+        print("{}: {:.3g} s per loop".format(name, total / n_loops))